@@ -1,80 +1,135 @@
+import functools
 import html
 import logging
+import logging.handlers
 import re
 import sys
 import time
 
-import jsonschema
+import fastjsonschema
 from praw import Reddit
-from praw.models.reddit.comment import Comment
-from praw.models.reddit.submission import Submission
+from praw.models.util import ExponentialCounter
 from prawcore.exceptions import NotFound
 import yaml
 
+try:
+    from yaml import CSafeLoader as YAML_LOADER
+except ImportError:  # PyYAML built without libyaml.
+    from yaml import SafeLoader as YAML_LOADER
 
-REGEX_RULE = re.compile(r"[@!]say (\w*) *(.*)", re.IGNORECASE)
-REGEX_TEMP_BAN = re.compile(
-    r'[@!]notinuse (\d*) "([^"]*)" "([^"]*)"', re.IGNORECASE
+
+REGEX_COMMAND = re.compile(
+    r"^[@!](?:"
+    r"(?P<say>say (?P<rule>\w*) *(?P<note>.*))"
+    r'|(?P<temp_ban>notinuse (?P<duration>\d*) "(?P<temp_reason>[^"]*)"'
+    r' "(?P<temp_msg>[^"]*)")'
+    r'|(?P<perm_ban>notinuse "(?P<perm_reason>[^"]*)" "(?P<perm_msg>[^"]*)")'
+    r"|(?P<spam>unused)$"
+    r")",
+    re.IGNORECASE,
 )
-REGEX_PERM_BAN = re.compile(r'[@!]notinuse "([^"]*)" "([^"]*)"', re.IGNORECASE)
-REGEX_REFRESH = re.compile(r"[@!]refreshsay (.*)", re.IGNORECASE)
-REGEX_SPAM = re.compile(r"[@!]unused$", re.IGNORECASE)
+REGEX_REFRESH = re.compile(r"^[@!]refreshsay (.*)", re.IGNORECASE)
 
-SCHEMA_VALIDATOR = jsonschema.Draft7Validator(
-    yaml.safe_load(
-        r"""
+SCHEMA = yaml.load(
+    r"""
+    type: object
+    required:
+        - Header
+        - Footer
+        - Generic
+    properties:
+        Header:
+            type: string
+        Footer:
+            type: string
+    additionalProperties:
         type: object
-        required:
-            - Header
-            - Footer
-            - Generic
         properties:
-            Header:
+            Flair:
                 type: string
-            Footer:
+            Message:
                 type: string
-        additionalProperties:
-            type: object
-            properties:
-                Flair:
-                    type: string
-                Message:
-                    type: string
-        propertyNames:
-            pattern: "^\\w+$"
-        """
-    )
+    propertyNames:
+        pattern: "^\\w+$"
+    """,
+    Loader=YAML_LOADER,
 )
+# Compiled once per process; fastjsonschema generates a specialized function.
+_VALIDATE = fastjsonschema.compile(SCHEMA)
+
+
+@functools.lru_cache(maxsize=128)
+def format_header_footer(header, footer, author):
+    return header.format(author=author), footer.format(author=author)
+
+
+def fullname_kind(fullname):
+    # Comment fullnames are prefixed with t1_, submissions with t3_.
+    return "comment" if fullname.startswith("t1_") else "submission"
+
+
+def drain_stream(streams, key, reopen, name):
+    # Yields the new items of streams[key] until it has caught up. A PRAW
+    # stream ends for good on the first API error, so it is replaced with
+    # reopen() straight away; a second failure waits for the next cycle.
+    restarted = False
+    while True:
+        try:
+            item = next(streams[key])
+        except Exception:
+            logging.warning(
+                "%s stream failed, restarting it", name, exc_info=True
+            )
+            streams[key] = reopen()
+            if restarted:
+                return
+            restarted = True
+            continue
+        if item is None:
+            return
+        yield item
 
 
 class Bot:
     def __init__(self, r):
         self.r = r
         logging.debug("Success.")
-        self.logging_enabled = True
         self.subreddits = {}
         for subreddit in SUBREDDITS:
             logging.info("Checking subreddit: %s…", subreddit)
-            mods, reasons = self.load_sub_config(subreddit)
-            self.subreddits[subreddit] = {
-                "mods": mods,
-                "reasons": reasons,
+            sub = self.subreddits[subreddit] = {
+                "handle": self.r.subreddit(subreddit),
+                "log_buffer": [],
+                # Last raw wiki config that passed validation.
+                "validated_raw": None,
             }
+            mods, reasons = self.load_sub_config(subreddit)
+            sub["mods"] = mods
+            sub["reasons"] = reasons
+            # Local copy of r/<subreddit>/wiki/saybot_logs, None while the page
+            # is missing. Reloaded whenever the subreddit is refreshed.
+            sub["log_content"] = self.load_logs(subreddit)
+            # pause_after=-1 makes streams yield None once caught up, so they
+            # can be drained in turn from a single loop.
+            sub["comments"] = sub["handle"].stream.comments(pause_after=-1)
+        self.streams = {"mail": self.r.inbox.stream(pause_after=-1)}
 
     def load_sub_config(self, subreddit):
+        sub = self.subreddits[subreddit]
+        handle = sub["handle"]
         logging.debug("Loading mods…")
-        mods = [mod.name for mod in self.r.subreddit(subreddit).moderator()]
-        logging.info("Mods loaded: %s.", mods)
+        mods = frozenset(mod.name for mod in handle.moderator())
+        logging.info("Mods loaded: %s.", sorted(mods))
         logging.debug("Loading reasons…")
         try:
-            reasons = yaml.safe_load(
-                html.unescape(
-                    self.r.subreddit(subreddit).wiki["saybot"].content_md
-                )
-            )
-            SCHEMA_VALIDATOR.validate(reasons)
+            raw = handle.wiki["saybot"].content_md
+            text = html.unescape(raw) if "&" in raw else raw
+            reasons = yaml.load(text, Loader=YAML_LOADER)
+            if raw != sub["validated_raw"]:
+                _VALIDATE(reasons)
+                sub["validated_raw"] = raw
             logging.info("Reasons loaded.")
-        except (jsonschema.exceptions.ValidationError, NotFound):
+        except (fastjsonschema.JsonSchemaException, NotFound):
             reasons = None
             logging.warning(
                 "r/%s/wiki/saybot not found or invalid, ignoring", subreddit
@@ -88,149 +143,213 @@ class Bot:
         sub["mods"] = mods
         if reasons is not None:
             sub["reasons"] = reasons
+        try:
+            sub["log_content"] = self.load_logs(subreddit)
+        except Exception as exception:
+            # Keep the current copy so the refresh still gets its reply.
+            logging.exception(exception)
 
     def check_comments(self, subreddit):
         logging.debug("Checking subreddit: %s…", subreddit)
         sub = self.subreddits[subreddit]
-        for comment in self.r.subreddit(subreddit).comments(limit=100):
-            if (
-                comment.banned_by
-                or not comment.author
-                or comment.author.name not in sub["mods"]
-            ):
+        handled = False
+        for comment in drain_stream(
+            sub,
+            "comments",
+            lambda: self.reopen_comments(subreddit),
+            f"r/{subreddit} comment",
+        ):
+            if comment.banned_by:
                 continue
+            author = comment.author
+            if not author:
+                continue
+            name = author.name
+            if name not in sub["mods"]:
+                continue
+            body = comment.body
+            if not body.startswith(("@", "!")):
+                continue
+            if self.handle_report(
+                subreddit,
+                reason=body,
+                author=name,
+                source=comment,
+                target_kind=fullname_kind(comment.parent_id),
+            ):
+                handled = True
+        return handled
 
-            report = {
-                "source": comment,
-                "reason": comment.body,
-                "author": comment.author.name,
-            }
-            self.handle_report(subreddit, report, comment.parent())
+    def reopen_comments(self, subreddit):
+        # Starting over from the listing would handle old commands again.
+        logging.warning(
+            "Comments posted to r/%s while its stream was down may have been "
+            "skipped",
+            subreddit,
+        )
+        return self.subreddits[subreddit]["handle"].stream.comments(
+            pause_after=-1, skip_existing=True
+        )
 
     def check_reports(self, subreddit):
         logging.debug("Checking subreddit reports: %s…", subreddit)
-        for reported_submission in self.r.subreddit(subreddit).mod.reports():
+        sub = self.subreddits[subreddit]
+        # Polled rather than streamed: a stream yields each item only once,
+        # so mod reports added to an already-seen item would be missed.
+        handled = False
+        for reported_submission in sub["handle"].mod.reports():
             if not reported_submission.mod_reports:
                 continue
+            reason, author = reported_submission.mod_reports[0]
+            if self.handle_report(
+                subreddit,
+                reason=reason,
+                author=author,
+                source=None,
+                target=reported_submission,
+                target_kind=fullname_kind(reported_submission.fullname),
+            ):
+                handled = True
+        return handled
 
-            report = {
-                "source": None,
-                "reason": reported_submission.mod_reports[0][0],
-                "author": reported_submission.mod_reports[0][1],
-            }
-            self.handle_report(subreddit, report, reported_submission)
-
-    def handle_report(self, subreddit, report, target):
+    def handle_report(
+        self, subreddit, *, reason, author, source, target_kind, target=None
+    ):
+        if not reason.startswith(("@", "!")):
+            return False
+        if not (match := REGEX_COMMAND.match(reason)):
+            return False
+        # The command's outer group is the last one to close.
+        command = match.lastgroup
+        if target is None:
+            target = source.parent()
         sub = self.subreddits[subreddit]
-        # Check for @rule command.
-        match = REGEX_RULE.search(report["reason"])
-        if match:
-            rule = match.group(1)
-            note = match.group(2)
+        target_author = target.author
+        target_name = target_author.name if target_author is not None else None
+        if command == "say":
+            rule = match["rule"]
+            note = match["note"]
             logging.info("Comment %s matched.", rule)
-            if rule not in sub["reasons"]:
+            reasons = sub["reasons"]
+            if rule not in reasons:
                 rule = "Generic"
-            msg = sub["reasons"][rule]["Message"]
+            msg = reasons[rule]["Message"]
             if note:
                 msg = f"{msg}\n\n{note}"
 
-            if report["source"] is not None:
-                report["source"].mod.approve()
+            if source is not None:
+                source.mod.approve()
             target.mod.approve()
 
-            author = target.author.name if target.author is not None else "OP"
-            header = sub["reasons"]["Header"].format(author=author)
-            footer = sub["reasons"]["Footer"].format(author=author)
-            msg = f"{msg}"
+            header, footer = format_header_footer(
+                reasons["Header"], reasons["Footer"], target_name or "OP"
+            )
+            msg = f"{header}\n\n{msg}\n\n{footer}"
             target.reply(msg).mod.distinguish(sticky=True)
 
-            if isinstance(target, Submission):
+            if target_kind == "submission":
                 logging.info("Posted comment.")
-                target.mod.flair(sub["reasons"][rule]["Flair"])
-            elif isinstance(target, Comment):
+                target.mod.flair(reasons[rule]["Flair"])
+            else:
                 logging.info("Removed comment.")
 
             permalink = target.permalink
-            self.log(subreddit, f"{report['author']} removed {permalink}")
-        # Check for @spam command.
-        if REGEX_SPAM.search(report["reason"]):
-            if report["source"] is not None:
-                report["source"].mod.remove()
+            self.log(subreddit, f"{author} removed {permalink}")
+        elif command == "spam":
+            if source is not None:
+                source.mod.remove()
             target.mod.remove(spam=True)
-            if isinstance(target, Submission):
+            if target_kind == "submission":
                 logging.info("Removed submission (spam).")
                 permalink = target.permalink
-            elif isinstance(target, Comment):
+            else:
                 logging.info("Removed comment (spam).")
                 permalink = target.permalink(fast=True)
-            self.log(
-                subreddit, f"{report['author']} removed {permalink} (spam)"
-            )
-        # Check for @ban command.
-        temp_match = REGEX_TEMP_BAN.search(report["reason"])
-        perma_match = REGEX_PERM_BAN.search(report["reason"])
-        if temp_match or perma_match:
-            if target.author is None:
+            self.log(subreddit, f"{author} removed {permalink} (spam)")
+        else:
+            if target_name is None:
                 logging.info("Skipping ban for [deleted] user")
-            elif temp_match:
-                duration = temp_match.group(1)
-                reason = temp_match.group(2)
-                msg = temp_match.group(3)
+            elif command == "temp_ban":
+                duration = match["duration"]
+                ban_reason = match["temp_reason"]
+                msg = match["temp_msg"]
                 logging.info(
-                    "Ban (%s: %s -- %s) matched.", duration, reason, msg
+                    "Ban (%s: %s -- %s) matched.", duration, ban_reason, msg
                 )
-                self.r.subreddit(subreddit).banned.add(
-                    target.author.name,
+                sub["handle"].banned.add(
+                    target_name,
                     duration=duration,
-                    note=reason,
+                    note=ban_reason,
                     ban_message=msg,
                 )
-            elif perma_match:
-                reason = perma_match.group(1)
-                msg = perma_match.group(2)
-                logging.info("Ban (Permanent: %s -- %s) matched.", reason, msg)
-                self.r.subreddit(subreddit).banned.add(
-                    target.author.name, note=reason, ban_message=msg
+            else:
+                ban_reason = match["perm_reason"]
+                msg = match["perm_msg"]
+                logging.info(
+                    "Ban (Permanent: %s -- %s) matched.", ban_reason, msg
+                )
+                sub["handle"].banned.add(
+                    target_name, note=ban_reason, ban_message=msg
                 )
-            if report["source"] is not None:
-                report["source"].mod.remove()
+            if source is not None:
+                source.mod.remove()
             target.mod.remove()
-            if target.author is not None:
+            if target_name is not None:
                 logging.info("User banned.")
-                self.log(
-                    subreddit,
-                    f"{report['author']} banned u/{target.author.name}",
-                )
+                self.log(subreddit, f"{author} banned u/{target_name}")
+        return True
 
     def log(self, subreddit, msg):
-        if not self.logging_enabled:
+        sub = self.subreddits[subreddit]
+        if sub["log_content"] is None:
             return
-        logs_page = self.r.subreddit(subreddit).wiki["saybot_logs"]
+        sub["log_buffer"].append(msg)
+
+    def load_logs(self, subreddit):
+        logs_page = self.subreddits[subreddit]["handle"].wiki["saybot_logs"]
         try:
-            logs_content = logs_page.content_md
+            return logs_page.content_md
         except TypeError:
-            logs_content = ""
+            return ""
         except NotFound:
             logging.warning(
                 "r/%s/wiki/saybot_logs not found, disabling logging",
                 subreddit,
             )
-            self.logging_enabled = False
-            return
-        logs_page.edit(f"{logs_content}{msg}  \n")
+            return None
+
+    def flush_logs(self):
+        for sub in self.subreddits.values():
+            if not sub["log_buffer"]:
+                continue
+            if sub["log_content"] is None:
+                # The page went missing after these entries were buffered.
+                sub["log_buffer"].clear()
+                continue
+            entries = "".join(f"{msg}  \n" for msg in sub["log_buffer"])
+            logs_content = f"{sub['log_content']}{entries}"
+            sub["handle"].wiki["saybot_logs"].edit(logs_content)
+            sub["log_content"] = logs_content
+            sub["log_buffer"].clear()
 
     def check_mail(self):
         logging.debug("Checking mail…")
-        for mail in self.r.inbox.unread():
+        # Handled mail is marked read, so a reopened stream never repeats it.
+        for mail in drain_stream(
+            self.streams,
+            "mail",
+            lambda: self.r.inbox.stream(pause_after=-1),
+            "Inbox",
+        ):
             mail.mark_read()
             logging.info('New mail: "%s".', mail.body)
-            match = REGEX_REFRESH.search(mail.body)
+            match = REGEX_REFRESH.match(mail.body)
             if not match:
                 continue
             subreddit = match.group(1)
             if subreddit in self.subreddits:
                 sub = self.subreddits[subreddit]
-                if mail.author in sub["mods"]:
+                if mail.author and mail.author.name in sub["mods"]:
                     self.refresh_sub(subreddit)
                     mail.reply(f"Refreshed mods and reasons for {subreddit}!")
                 else:
@@ -239,27 +358,42 @@ class Bot:
                 mail.reply(f"Unrecognized sub: {subreddit}.")
 
     def run(self):
+        # Poll again quickly right after a command was handled, since mods
+        # often issue several in a row, and back off to 32s otherwise.
+        backoff = ExponentialCounter(max_counter=32)
         while True:
             logging.debug("Running cycle…")
+            active = False
             for subreddit in SUBREDDITS:
                 if self.subreddits[subreddit]["reasons"] is None:
                     continue
                 try:
-                    self.check_comments(subreddit)
-                    self.check_reports(subreddit)
+                    if self.check_comments(subreddit):
+                        active = True
+                    if self.check_reports(subreddit):
+                        active = True
                 except Exception as exception:
                     logging.exception(exception)
             try:
                 self.check_mail()
             except Exception as exception:
                 logging.exception(exception)
+            try:
+                self.flush_logs()
+            except Exception as exception:
+                logging.exception(exception)
             logging.debug("Sleeping…")
-            time.sleep(32)  # PRAW caches responses for 30s.
+            # Write out the cycle's buffered log records before idling.
+            for handler in logging.getLogger().handlers:
+                handler.flush()
+            if active:
+                backoff.reset()
+            time.sleep(backoff.counter())
 
 
 if __name__ == "__main__":
     with open("config.yaml") as config_file:
-        CONFIG = yaml.safe_load(config_file)
+        CONFIG = yaml.load(config_file, Loader=YAML_LOADER)
         CLIENT_ID = CONFIG["Client ID"]
         CLIENT_SECRET = CONFIG["Client Secret"]
         USERNAME = CONFIG["Username"]
@@ -267,10 +401,17 @@ if __name__ == "__main__":
         SUBREDDITS = CONFIG["Subreddits"]
         USER_AGENT = CONFIG["User Agent"]
 
+    STDOUT_HANDLER = logging.StreamHandler(sys.stdout)
+    STDOUT_HANDLER.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s: %(message)s")
+    )
     logging.basicConfig(
-        stream=sys.stdout,
         level=logging.INFO,
-        format="%(asctime)s %(levelname)s: %(message)s",
+        handlers=[
+            logging.handlers.MemoryHandler(
+                512, flushLevel=logging.WARNING, target=STDOUT_HANDLER
+            )
+        ],
     )
     logging.info("Logging in…")
     MODBOT = Bot(